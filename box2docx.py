@@ -1,4 +1,6 @@
 import os
+import io
+import copy
 import json
 import sys
 import time
@@ -8,9 +10,16 @@ import argparse
 import logging
 import subprocess
 import traceback
+import itertools
+import string
 
 from enum import Enum
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from dataclasses import dataclass, field
+from typing import Iterator
 
+import docx
 from docx import Document
 from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_COLOR_INDEX
 from docx.shared import RGBColor, Pt, Length
@@ -18,6 +27,15 @@ from docx.oxml.ns import qn
 from docx.oxml.parser import OxmlElement
 from docx.opc.constants import RELATIONSHIP_TYPE
 from docx.text.run import Run
+from docx.text.paragraph import Paragraph
+from docx.table import Table, _Cell
+from docx.document import Document as WordDocument
+
+# orjson is optional, but parses boxnote JSON much faster than the standard library
+try:
+    import orjson as json_parser
+except ImportError:
+    json_parser = json
 
 # globals
 logger = logging.getLogger(__name__)
@@ -25,30 +43,7 @@ logging.basicConfig(level=logging.INFO, format='🐞 %(message)s')
 
 DRY_RUN = False
 UPDATE_LEGACY_BOXNOTES = False
-
-# Track certain things globally while we recurse through the content
-document = None
-current_paragraph = None
-current_path = None
-use_table_cell_paragraph = False
-current_table_cell = None
-
-list_type = None
-list_depths = {}
-bullet_list_level = 0
-ordered_list_level = 0
-check_list_level = 0
-
-in_bullet_list_item = False
-in_ordered_list_item = False
-in_check_list_item = False
-is_check_list_item_checked = False
-
-in_callout = False
-callout_emoji = None
-callout_bg_color = None
-
-in_code_block = False
+FORCE = False
 
 # Word limits highlights to a small pallete. Here's the mapping from Box options to Word options
 highlight_map = {
@@ -61,16 +56,39 @@ highlight_map = {
     "#e8e8e8": WD_COLOR_INDEX.GRAY_25,
 }
 heading_level_to_size_map = {"1": Pt(28), "2": Pt(20), "3": Pt(16)}
+alignment_map = {
+    "center": WD_ALIGN_PARAGRAPH.CENTER,
+    "right": WD_ALIGN_PARAGRAPH.RIGHT,
+    "justify": WD_ALIGN_PARAGRAPH.JUSTIFY,
+}
 
 # Track which files failed to open or write for retry string output
 failed_files = []
 
 # Constants
 INDENT = "    "
+INDENTS = [INDENT * depth for depth in range(16)]  # prebuilt indents for common list depths
+LETTER_LIST_CHARS = [letter + "." for letter in string.ascii_lowercase]  # "a." to "z."
+PT_PER_EM = 1 / 0.083646
+EMU_PER_INCH = 914400
+DOCUMENT_IMAGE_WIDTH = Length(6 * EMU_PER_INCH)
+TABLE_CELL_IMAGE_WIDTH = Length(1 * EMU_PER_INCH)
 HOME = str(pathlib.Path.home())
 OS_X_BOX_ROOT = os.path.sep.join([HOME, "Library", "CloudStorage", "Box-Box"])
 WIN_BOX_ROOT = os.path.sep.join([HOME, "Box"])
-BOX_ROOTS = [OS_X_BOX_ROOT, WIN_BOX_ROOT]  # Bit of a hack
+# Bit of a hack. Normalized so they compare equal to normcase'd parent folders
+BOX_ROOTS = frozenset(os.path.normcase(os.path.normpath(p)) for p in [OS_X_BOX_ROOT, WIN_BOX_ROOT])
+
+# python-docx's blank document, read once so each conversion doesn't reload it from disk
+DEFAULT_TEMPLATE = (pathlib.Path(docx.__file__).parent / "templates" / "default.docx").read_bytes()
+
+# Namespace-qualified XML attribute names, resolved once instead of on every run/cell
+QN_R_ID = qn("r:id")
+QN_VAL = qn("w:val")
+QN_COLOR = qn("w:color")
+QN_FILL = qn("w:fill")
+QN_SZ = qn("w:sz")
+QN_SPACE = qn("w:space")
 
 # Enums
 class Format(Enum):
@@ -78,6 +96,59 @@ class Format(Enum):
     MD = 'md'
     HTML = 'html'
 
+# State tracked while we walk through a boxnote's content
+@dataclass
+class ParseContext:
+    document: WordDocument
+    current_path: pathlib.Path
+    current_paragraph: Paragraph | None = None
+    use_table_cell_paragraph: bool = False
+    current_table_cell: _Cell | None = None
+    current_table: Table | None = None
+    # Table, cell and use_table_cell_paragraph enclosing the current table,
+    # restored as each nested table finishes
+    enclosing_tables: list[tuple[Table | None, _Cell | None, bool]] = field(default_factory=list)
+
+    list_type: str | None = None
+    list_depths: dict[int, int] = field(default_factory=dict)
+    bullet_list_level: int = 0
+    ordered_list_level: int = 0
+    check_list_level: int = 0
+
+    in_bullet_list_item: bool = False
+    in_ordered_list_item: bool = False
+    in_check_list_item: bool = False
+    is_check_list_item_checked: bool = False
+    # Paragraph holding the latest checkbox, and the index of the first run after it
+    check_list_paragraph: Paragraph | None = None
+    check_strike_start: int = 0
+
+    in_callout: bool = False
+    callout_emoji: str | None = None
+    callout_bg_color: str | None = None
+    table_cell_outside_callout: _Cell | None = None
+
+    in_code_block: bool = False
+
+    # Relationship ids of the hyperlinks added so far, by url
+    link_r_ids: dict[str, str] = field(default_factory=dict)
+
+    # Plain text version of the boxnote, built up in pieces and joined at the end
+    output_chunks: list[str] = field(default_factory=list)
+
+# Formatting collected from the marks on a text node
+@dataclass
+class TextStyle:
+    is_bold: bool = False
+    is_italic: bool = False
+    is_underline: bool = False
+    is_strikethrough: bool = False
+    font_color: RGBColor | None = None
+    highlight_color: WD_COLOR_INDEX | None = None
+    font_size: Length | None = None
+    is_hyperlink: bool = False
+    url: str | None = None
+
 # Custom exceptions
 class OldBoxNoteFormatError(Exception):
     pass
@@ -89,6 +160,7 @@ def main() -> None:
     parser.add_argument('--recursive', action='store_true', help="Convert all boxnotes within all subdirectories of the specified directory")
     parser.add_argument('--update_legacy_boxnotes', action='store_true', help="Update legacy Box Notes (created prior to August 2022) by opening them in your web browser (caution: may open a lot of browser tabs)")
     parser.add_argument('--dry-run', action='store_true', help="Perform a dry run (doesn't actually convert any files)")
+    parser.add_argument('--force', action='store_true', help="Convert boxnotes even if a converted file already exists, overwriting it")
     parser.add_argument('--debug', action='store_true', help='write debugging information to the console')
     args = parser.parse_args()
 
@@ -102,6 +174,11 @@ def main() -> None:
         print("⚙️ will update legacy boxnotes to the newer format")
         UPDATE_LEGACY_BOXNOTES = True
     
+    global FORCE
+    if args.force:
+        print("⚠️ will overwrite files that have already been converted")
+        FORCE = True
+    
     if args.debug:
         logger.setLevel(logging.DEBUG)
         logger.debug("debug mode on")
@@ -124,21 +201,27 @@ def main() -> None:
 
 # Convert a directory of files
 def convert_dir(path: pathlib.Path, recursively: bool, format: format) -> None:
-    boxnotes = []
     failed_boxnotes = []
     if recursively is True:
         print(f"🔍 searching directory {path} and all subdirectories for boxnotes")
-        boxnotes = [file_path for file_path in path.rglob(pattern='*.boxnote')]
     else:
         print(f"🔍 searching directory {path} for boxnotes")
-        boxnotes = [file_path for file_path in path.glob(pattern='*.boxnote')]
-    
-    print(f'🔍 found {len(boxnotes)} boxnotes')
-
-    for b in boxnotes:
-        if not convert_file(path=b, format=format):
-            failed_boxnotes.append(b)
-    
+    boxnotes = find_boxnotes(path=path, recursively=recursively)
+
+    # Boxnotes are independent of each other, so convert them in parallel.
+    # They are handed to the workers as they are found, so conversion starts
+    # while we are still searching the rest of the directory
+    num_boxnotes = 0
+    with ProcessPoolExecutor(
+        initializer=init_worker,
+        initargs=(DRY_RUN, UPDATE_LEGACY_BOXNOTES, FORCE, logger.level),
+    ) as executor:
+        for b, is_converted in executor.map(convert_file_worker, boxnotes, itertools.repeat(format), chunksize=4):
+            num_boxnotes += 1
+            if not is_converted:
+                failed_boxnotes.append(b)
+
+    print(f'🔍 found {num_boxnotes} boxnotes')
     print()
     print("Conversion finished!")
     if len(failed_boxnotes) > 0:
@@ -147,6 +230,32 @@ def convert_dir(path: pathlib.Path, recursively: bool, format: format) -> None:
     else:
         print("All boxnotes were converted successfully.")
 
+# Lazily find the boxnotes in a directory
+def find_boxnotes(path: pathlib.Path, recursively: bool) -> Iterator[pathlib.Path]:
+    if recursively is True:
+        return path.rglob(pattern='*.boxnote')
+    return path.glob(pattern='*.boxnote')
+
+# Set up a worker process with the options chosen on the command line,
+# since worker processes don't necessarily inherit the main process's globals
+def init_worker(dry_run: bool, update_legacy_boxnotes: bool, force: bool, log_level: int) -> None:
+    global DRY_RUN, UPDATE_LEGACY_BOXNOTES, FORCE
+    DRY_RUN = dry_run
+    UPDATE_LEGACY_BOXNOTES = update_legacy_boxnotes
+    FORCE = force
+    logger.setLevel(log_level)
+
+# Convert a single file in a worker process, reporting back which file it was.
+# Errors are reported as a failed file rather than raised, so one bad path
+# doesn't abort collecting the rest of the results
+def convert_file_worker(path: pathlib.Path, format: Format) -> tuple[pathlib.Path, bool]:
+    try:
+        return path, convert_file(path=path, format=format)
+    except Exception as e:
+        logger.debug(f"an unhandled exception occurred: {e}")
+        print(traceback.format_exc())
+        return path, False
+
 # Convert a single file
 def convert_file(path: pathlib.Path, format: Format) -> None:
     if is_valid_path(path=path):
@@ -170,8 +279,7 @@ def open_with_retry(path: pathlib.Path):
     num_tries = 0
     while True:
         try:
-            with path.open() as f:
-                bn_json = json.load(f)
+            bn_json = json_parser.loads(path.read_bytes())
             break
         except TimeoutError:
             if num_tries >= len(timeouts):
@@ -193,21 +301,19 @@ def convert_boxnote(path: pathlib.Path, format: Format) -> None:
     title = path.stem # remove ".boxnote"
     output_path = path.parent.joinpath(path.stem).with_suffix(suffix='.docx')
 
-    if output_path.exists():
+    if output_path.exists() and not FORCE:
         print(f"⚠️ skipping {path.name}, converted file already exists → {output_path}")
-    else:
-        print(f"📄 converting {path.name} to {format} → {output_path}")
+        return True
+
+    print(f"📄 converting {path.name} to {format} → {output_path}")
 
     if DRY_RUN:
         return
-    
-    global current_path
-    current_path = path.absolute()
 
     try:
         bn_json = open_with_retry(path=path)
-        logger.debug(f"loaded boxnote JSON:\n{repr(bn_json)}")
-        return parse_boxnote_json(bn_json=bn_json, title=title, output_path=output_path.absolute())
+        logger.debug("loaded boxnote JSON:\n%r", bn_json)  # lazy, only built in debug mode
+        return parse_boxnote_json(bn_json=bn_json, title=title, output_path=output_path.absolute(), current_path=path.absolute())
     except OldBoxNoteFormatError:
         if UPDATE_LEGACY_BOXNOTES is True:
             print(f"⚙️ upgrading {path.name} → this boxnote is in an older fomat (prior to August 2022)")
@@ -221,21 +327,19 @@ def convert_boxnote(path: pathlib.Path, format: Format) -> None:
         return False
 
 # Parse JSON and build word document
-def parse_boxnote_json(bn_json, title: str, output_path: pathlib.Path):
-    global document, current_paragraph
-
-    output = title + "\n"
-
-    if "doc" in bn_json.keys():
+def parse_boxnote_json(bn_json, title: str, output_path: pathlib.Path, current_path: pathlib.Path):
+    if "doc" in bn_json:
         doc = bn_json["doc"]
 
-        if "content" in doc.keys():
-            document = Document()
-            current_paragraph = document.add_paragraph()
-            current_paragraph.add_run(text=title).font.size = Pt(points=32)
+        if "content" in doc:
+            ctx = ParseContext(document=Document(io.BytesIO(DEFAULT_TEMPLATE)), current_path=current_path, output_chunks=[title, "\n"])
+            ctx.current_paragraph = ctx.document.add_paragraph()
+            ctx.current_paragraph.add_run(text=title).font.size = Pt(points=32)
             content_objs = doc["content"]
-            output = parse_contents(content_objs=content_objs, output=output)
-            document.save(path_or_stream=output_path)
+            parse_contents(ctx=ctx, content_objs=content_objs)
+            output = "".join(ctx.output_chunks)
+            logger.debug(f"parsed boxnote text:\n{output}")
+            ctx.document.save(path_or_stream=output_path)
             
             if output_path.exists() and output_path.is_file() and output_path.stat().st_size > 0:
                 return True
@@ -246,396 +350,360 @@ def parse_boxnote_json(bn_json, title: str, output_path: pathlib.Path):
         raise OldBoxNoteFormatError
 
 # Main entry into parsing is going to be the "content key"
-def parse_contents(content_objs, output):
-    for content_obj in content_objs:
-        if "type" in content_obj.keys():
-            output = parse_content_type(content_obj, content_obj["type"], output)
-    return output
-
-
-# Do different things depending on the obj_type we are parsing
-def parse_content_type(content_obj, type, output):
-    if type == "heading":
-        return parse_heading_type(content_obj, output)
-    elif type == "paragraph":
-        return parse_paragraph_type(content_obj, output)
-    elif type == "text":
-        return parse_text_type(content_obj, output)
-    elif type == "bullet_list":
-        return parse_bullet_list_type(content_obj, output)
-    elif type == "ordered_list":
-        return parse_ordered_list_type(content_obj, output)
-    elif type == "check_list":
-        return parse_check_list_type(content_obj, output)
-    elif type == "list_item":
-        return parse_list_item_type(content_obj, output)
-    elif type == "check_list_item":
-        return parse_check_list_item_type(content_obj, output)
-    elif type == "image":
-        return parse_image_type(content_obj, output)
-    elif type == "table":
-        return parse_table_type(content_obj, output)
-    elif type == "horizontal_rule":
-        return parse_horizontal_rule_type(content_obj, output)
-    elif type == "call_out_box":
-        return parse_call_out_box(content_obj, output)
-    elif type == "code_block":
-        return parse_code_block(content_obj, output)
-    elif type == "blockquote":
-        return parse_blockquote(content_obj, output)
-    return output
+# Content is walked with an explicit stack instead of recursion, so deeply nested
+# boxnotes can't hit the recursion limit. A handler returns the child content to walk
+# (or None if there is nothing to walk), and once those children have been walked the
+# content type's finish handler runs to undo whatever state the handler set up
+def parse_contents(ctx, content_objs):
+    stack = [(content_obj, False) for content_obj in reversed(content_objs)]
+    while stack:
+        content_obj, is_finishing = stack.pop()
+        content_type = content_obj.get("type")
+        if is_finishing:
+            content_type_finish_handler_map[content_type](ctx, content_obj)
+            continue
+
+        handler = content_type_handler_map.get(content_type)
+        if handler is None:
+            continue
+        child_objs = handler(ctx, content_obj)
+        if child_objs is None:
+            continue
+
+        if content_type in content_type_finish_handler_map:
+            stack.append((content_obj, True))
+        stack.extend((child_obj, False) for child_obj in reversed(child_objs))
 
 
 # Handle headings
-def parse_heading_type(content_obj, output):
-    global document, current_paragraph, heading_level_to_size_map
-    current_paragraph = document.add_paragraph()
+def parse_heading_type(ctx, content_obj):
+    ctx.current_paragraph = ctx.document.add_paragraph()
+
+    if "content" in content_obj:
+        return content_obj["content"]
+    else:  # empty heading
+        ctx.output_chunks.append("\n")
+        return None
+
+
+# Size a heading's runs once its content has been parsed
+def finish_heading_type(ctx, content_obj):
     heading_size = heading_level_to_size_map["1"]
 
-    if "attrs" in content_obj.keys() and "level" in content_obj["attrs"]:
+    if "attrs" in content_obj and "level" in content_obj["attrs"]:
         heading_level = str(content_obj["attrs"]["level"])
-        if heading_level in heading_level_to_size_map.keys():
+        if heading_level in heading_level_to_size_map:
             heading_size = heading_level_to_size_map[heading_level]
-    if "content" in content_obj.keys():
-        result = parse_contents(content_obj["content"], output)
-        for run in current_paragraph.runs:
-            run.font.size = heading_size
-        return result + "\n"
-    else:  # empty heading
-        return output + "\n"
+    for run in ctx.current_paragraph.runs:
+        run.font.size = heading_size
+    ctx.output_chunks.append("\n")
 
 
 # Handle paragraphs
-def parse_paragraph_type(content_obj, output):
-    global document, current_paragraph, list_depths, ordered_list_level, is_check_list_item_checked, current_table_cell, use_table_cell_paragraph, in_callout, callout_emoji
+def parse_paragraph_type(ctx, content_obj):
     if (
-        use_table_cell_paragraph
+        ctx.use_table_cell_paragraph
     ):  # happens due to table cells already having a paragraph
-        current_paragraph = current_table_cell.paragraphs[0]
-        use_table_cell_paragraph = False
+        ctx.current_paragraph = ctx.current_table_cell.paragraphs[0]
+        ctx.use_table_cell_paragraph = False
     else:
-        if current_table_cell is None:
-            current_paragraph = document.add_paragraph()
+        if ctx.current_table_cell is None:
+            ctx.current_paragraph = ctx.document.add_paragraph()
         else:
-            current_paragraph = current_table_cell.add_paragraph()
-
-    if in_bullet_list_item:
-        for _ in range(bullet_list_level - 1):
-            current_paragraph.add_run(INDENT)
-        current_paragraph.add_run("\u2022 ")
-
-    elif in_ordered_list_item:
-        for _ in range(ordered_list_level - 1):
-            current_paragraph.add_run(INDENT)
-        current_paragraph.add_run(
-            get_ordered_list_char(ordered_list_level, list_depths[ordered_list_level])
+            ctx.current_paragraph = ctx.current_table_cell.add_paragraph()
+
+    if ctx.in_bullet_list_item:
+        add_list_indent(ctx.current_paragraph, ctx.bullet_list_level)
+        ctx.current_paragraph.add_run("\u2022 ")
+
+    elif ctx.in_ordered_list_item:
+        add_list_indent(ctx.current_paragraph, ctx.ordered_list_level)
+        ctx.current_paragraph.add_run(
+            get_ordered_list_char(ctx.ordered_list_level, ctx.list_depths[ctx.ordered_list_level])
             + " "
         )
 
-    elif in_check_list_item:
-        for _ in range(check_list_level - 1):
-            current_paragraph.add_run(INDENT)
-        current_paragraph.add_run(
-            "\u2611 " if is_check_list_item_checked else "\u2610 "
+    elif ctx.in_check_list_item:
+        add_list_indent(ctx.current_paragraph, ctx.check_list_level)
+        ctx.current_paragraph.add_run(
+            "\u2611 " if ctx.is_check_list_item_checked else "\u2610 "
         )
-    elif in_callout:
-        # Callout gets put in a table since that's close enough
-        callout_table = document.add_table(1,1)
-        cell = callout_table.cell(0,0)
-        set_cell_background_color(cell, callout_bg_color)
-        
-        current_paragraph = cell.add_paragraph()
-        current_paragraph.add_run(" " + callout_emoji + "  ")
+        ctx.check_list_paragraph = ctx.current_paragraph
+        ctx.check_strike_start = len(ctx.current_paragraph.runs)
 
     alignment = WD_ALIGN_PARAGRAPH.LEFT
-    if "marks" in content_obj.keys():
-        for mark_obj in content_obj["marks"]:
-            if "type" in mark_obj:
-                if (
-                    mark_obj["type"] == "alignment"
-                    and "attrs" in mark_obj.keys()
-                    and "alignment" in mark_obj["attrs"].keys()
-                ):
-                    if mark_obj["attrs"]["alignment"] == "center":
-                        alignment = WD_ALIGN_PARAGRAPH.CENTER
-                    elif mark_obj["attrs"]["alignment"] == "right":
-                        alignment = WD_ALIGN_PARAGRAPH.RIGHT
-                    elif mark_obj["attrs"]["alignment"] == "justify":
-                        alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-    current_paragraph.alignment = alignment
-    if "content" in content_obj.keys():
-        return parse_contents(content_obj["content"], output) + "\n"
+    for mark_obj in content_obj.get("marks", ()):
+        attrs = mark_obj.get("attrs") or {}
+        if mark_obj.get("type") == "alignment" and "alignment" in attrs:
+            alignment = alignment_map.get(attrs["alignment"], alignment)
+    ctx.current_paragraph.alignment = alignment
+    if "content" in content_obj:
+        return content_obj["content"]
     else:  # empty paragraph
-        return output + "\n"
+        ctx.output_chunks.append("\n")
+        return None
+
+
+# Indent a list item's paragraph for its list level, using a single run
+def add_list_indent(paragraph, list_level):
+    depth = list_level - 1
+    if depth > 0:
+        paragraph.add_run(INDENTS[depth] if depth < len(INDENTS) else INDENT * depth)
 
-# Handle text
-def parse_text_type(content_obj, output):
-    global current_paragraph, highlight_map, in_callout, callout_bg_color
-    is_bold = False
-    is_italic = False
-    is_underline = False
-    is_strikethrough = False
-    font_color = None
-    highlight_color = None
-    font_size = None
-    is_hyperlink = False
-    url = None
-
-    if "marks" in content_obj.keys():
-        for mark_obj in content_obj["marks"]:
-            if "type" in mark_obj:
-                if mark_obj["type"] == "strong":
-                    is_bold = True
-                elif mark_obj["type"] == "em":
-                    is_italic = True
-                elif mark_obj["type"] == "underline":
-                    is_underline = True
-                elif mark_obj["type"] == "strikethrough":
-                    is_strikethrough = True
-                elif (
-                    mark_obj["type"] == "font_size"
-                    and "attrs" in mark_obj.keys()
-                    and "size" in mark_obj["attrs"]
-                ):
-                    font_size = get_pt_from_em(mark_obj["attrs"]["size"])
-                elif (
-                    mark_obj["type"] == "font_color"
-                    and "attrs" in mark_obj.keys()
-                    and "color" in mark_obj["attrs"]
-                ):
-                    font_color = get_color_from_hex(mark_obj["attrs"]["color"])
-                elif (
-                    mark_obj["type"] == "highlight"
-                    and "attrs" in mark_obj.keys()
-                    and "color" in mark_obj["attrs"]
-                ):
-                    hex = mark_obj["attrs"]["color"]
-                    if hex in highlight_map.keys():
-                        highlight_color = highlight_map[hex]
-                    else:
-                        highlight_color = WD_COLOR_INDEX.YELLOW
-                elif (
-                    mark_obj["type"] == "link"
-                    and "attrs" in mark_obj.keys()
-                    and "href" in mark_obj["attrs"]
-                ):
-                    is_hyperlink = True
-                    url = mark_obj["attrs"]["href"]
 
-    if "text" in content_obj.keys():
+# End a paragraph once its content has been parsed
+def finish_paragraph_type(ctx, content_obj):
+    ctx.output_chunks.append("\n")
+
+# Handle text
+def parse_text_type(ctx, content_obj):
+    style = TextStyle()
+    for mark_obj in content_obj.get("marks", ()):
+        mark_handler = text_mark_handler_map.get(mark_obj.get("type"))
+        if mark_handler is not None:
+            mark_handler(style, mark_obj.get("attrs") or {})
+
+    if "text" in content_obj:
         run = None
-        if is_hyperlink:
+        if style.is_hyperlink:
             # Library doesn't support creating hyperlinks. Doing it manually
-            part = current_paragraph.part
-            r_id = part.relate_to(url, RELATIONSHIP_TYPE.HYPERLINK, is_external=True)
+            r_id = ctx.link_r_ids.get(style.url)
+            if r_id is None:
+                part = ctx.current_paragraph.part
+                r_id = part.relate_to(style.url, RELATIONSHIP_TYPE.HYPERLINK, is_external=True)
+                ctx.link_r_ids[style.url] = r_id
 
             hyperlink = OxmlElement("w:hyperlink")
-            hyperlink.set(qn("r:id"), r_id)
+            hyperlink.set(QN_R_ID, r_id)
 
-            run = Run(OxmlElement("w:r"), current_paragraph)
+            run = Run(OxmlElement("w:r"), ctx.current_paragraph)
             run.text = content_obj["text"]
             hyperlink.append(run._element)
-            current_paragraph._p.append(hyperlink)
-            font_color = RGBColor(26, 116, 186)
-            is_underline = True
+            ctx.current_paragraph._p.append(hyperlink)
+            style.font_color = RGBColor(26, 116, 186)
+            style.is_underline = True
         else:
-            run = current_paragraph.add_run(content_obj["text"])
+            run = ctx.current_paragraph.add_run(content_obj["text"])
 
-        if is_bold:
+        if style.is_bold:
             run.bold = True
-        if is_italic:
+        if style.is_italic:
             run.italic = True
-        if is_underline:
+        if style.is_underline:
             run.underline = True
-        if is_strikethrough:
+        if style.is_strikethrough:
             run.font.strike = True
-        if font_color is not None:
-            run.font.color.rgb = font_color
-        if highlight_color is not None:
-            run.font.highlight_color = highlight_color
-        if font_size is not None:
-            run.font.size = font_size
-        if in_code_block:
+        if style.font_color is not None:
+            run.font.color.rgb = style.font_color
+        if style.highlight_color is not None:
+            run.font.highlight_color = style.highlight_color
+        if style.font_size is not None:
+            run.font.size = style.font_size
+        if ctx.in_code_block:
             run.font.name = "Courier"
         else:
           run.font.name = "Helvetica"
 
-        if in_callout:
-            set_run_background_color(run, callout_bg_color)
+        if ctx.in_callout:
+            set_run_background_color(run, ctx.callout_bg_color)
+
+        ctx.output_chunks.append(content_obj["text"])
+    return None
+
+# Handle a font size mark
+def parse_font_size_mark(style, attrs):
+    if "size" in attrs:
+        style.font_size = get_pt_from_em(attrs["size"])
+
+# Handle a font color mark
+def parse_font_color_mark(style, attrs):
+    if "color" in attrs:
+        style.font_color = get_color_from_hex(attrs["color"])
 
-        return output + content_obj["text"]
-    return output
+# Handle a highlight mark
+def parse_highlight_mark(style, attrs):
+    if "color" in attrs:
+        style.highlight_color = highlight_map.get(attrs["color"], WD_COLOR_INDEX.YELLOW)
+
+# Handle a link mark
+def parse_link_mark(style, attrs):
+    if "href" in attrs:
+        style.is_hyperlink = True
+        style.url = attrs["href"]
 
 # Set run background color
 def set_run_background_color(run, bg_color):
     tag = run._r
     shd = OxmlElement('w:shd')
-    shd.set(qn('w:val'), 'clear')
-    shd.set(qn('w:color'), 'auto')
-    shd.set(qn('w:fill'), bg_color)
+    shd.set(QN_VAL, 'clear')
+    shd.set(QN_COLOR, 'auto')
+    shd.set(QN_FILL, bg_color)
     # run.font.size = Pt(14)
     tag.rPr.append(shd)
 
 # Handle bullet lists
-def parse_bullet_list_type(content_obj, output):
-    global bullet_list_level, list_type
-    list_type = "bullet"
-    bullet_list_level += 1
-    if "content" in content_obj.keys():
-        result = parse_contents(content_obj["content"], output)
-        bullet_list_level -= 1
-        return result
-    return output
+def parse_bullet_list_type(ctx, content_obj):
+    ctx.list_type = "bullet"
+    ctx.bullet_list_level += 1
+    return content_obj.get("content")
+
+
+# Leave a bullet list once its items have been parsed
+def finish_bullet_list_type(ctx, content_obj):
+    ctx.bullet_list_level -= 1
 
 
 # Handle ordered lists
-def parse_ordered_list_type(content_obj, output):
-    global ordered_list_level, list_depths, list_type
-    list_type = "ordered"
-    ordered_list_level += 1
-    list_depths[ordered_list_level] = 0
-    if "content" in content_obj.keys():
-        result = parse_contents(content_obj["content"], output)
-        ordered_list_level -= 1
-        return result
-    return output
+def parse_ordered_list_type(ctx, content_obj):
+    ctx.list_type = "ordered"
+    ctx.ordered_list_level += 1
+    ctx.list_depths[ctx.ordered_list_level] = 0
+    return content_obj.get("content")
+
+
+# Leave an ordered list once its items have been parsed
+def finish_ordered_list_type(ctx, content_obj):
+    ctx.ordered_list_level -= 1
 
 
 # Handle checklists
-def parse_check_list_type(content_obj, output):
-    global check_list_level, list_type
-    list_type = "check"
-    check_list_level += 1
-    if "content" in content_obj.keys():
-        result = parse_contents(content_obj["content"], output)
-        check_list_level -= 1
-        return result
-    return output
+def parse_check_list_type(ctx, content_obj):
+    ctx.list_type = "check"
+    ctx.check_list_level += 1
+    return content_obj.get("content")
+
+
+# Leave a checklist once its items have been parsed
+def finish_check_list_type(ctx, content_obj):
+    ctx.check_list_level -= 1
 
 
 # Handle a checklist item
-def parse_check_list_item_type(content_obj, output):
-    global list_type, list_depths, check_list_level, in_check_list_item, is_check_list_item_checked
-    if "attrs" in content_obj.keys() and "checked" in content_obj["attrs"].keys():
+def parse_check_list_item_type(ctx, content_obj):
+    if "attrs" in content_obj and "checked" in content_obj["attrs"]:
         if content_obj["attrs"]["checked"]:
-            is_check_list_item_checked = True
+            ctx.is_check_list_item_checked = True
         else:
-            is_check_list_item_checked = False
-    if "content" in content_obj.keys():
+            ctx.is_check_list_item_checked = False
+    if "content" in content_obj:
         padding = ""
-        for _ in range(check_list_level):
+        for _ in range(ctx.check_list_level):
             padding += "  "
-        output += padding + ("\u2611 " if is_check_list_item_checked else "\u2610 ")
-        in_check_list_item = True
-        result = parse_contents(content_obj["content"], output)
-        in_check_list_item = False
-
-        if is_check_list_item_checked and len(current_paragraph.runs) > 1:
-            is_check_found = False
-            for run in current_paragraph.runs:
-                if is_check_found:
-                    run.font.strike = True
-                elif run.text.find("\u2611") > -1:
-                    is_check_found = True
-        return result
-    return output
+        ctx.output_chunks.append(padding + ("\u2611 " if ctx.is_check_list_item_checked else "\u2610 "))
+        ctx.in_check_list_item = True
+        return content_obj["content"]
+    return None
+
+
+# Leave a checklist item, striking through its text if it was checked
+def finish_check_list_item_type(ctx, content_obj):
+    ctx.in_check_list_item = False
+
+    if ctx.is_check_list_item_checked and ctx.current_paragraph is ctx.check_list_paragraph:
+        for run in ctx.current_paragraph.runs[ctx.check_strike_start:]:
+            run.font.strike = True
 
 
 # Handle either bullet or ordered list item
-def parse_list_item_type(content_obj, output):
-    global current_paragraph, in_bullet_list_item, in_ordered_list_item, list_type, list_depths, ordered_list_level
-    if list_type == "ordered":
-        list_depths[ordered_list_level] += 1
-    if "content" in content_obj.keys():
+def parse_list_item_type(ctx, content_obj):
+    if ctx.list_type == "ordered":
+        ctx.list_depths[ctx.ordered_list_level] += 1
+    if "content" in content_obj:
         padding = ""
-        if list_type == "bullet":
-            for _ in range(bullet_list_level):
+        if ctx.list_type == "bullet":
+            for _ in range(ctx.bullet_list_level):
                 padding += "  "
-            output += padding + "- "
-            in_bullet_list_item = True
-        elif list_type == "ordered":
-            for _ in range(ordered_list_level):
+            ctx.output_chunks.append(padding + "- ")
+            ctx.in_bullet_list_item = True
+        elif ctx.list_type == "ordered":
+            for _ in range(ctx.ordered_list_level):
                 padding += "  "
-            output += (
+            ctx.output_chunks.append(
                 padding
                 + get_ordered_list_char(
-                    ordered_list_level, list_depths[ordered_list_level]
+                    ctx.ordered_list_level, ctx.list_depths[ctx.ordered_list_level]
                 )
                 + " "
             )
-            in_ordered_list_item = True
-        result = parse_contents(content_obj["content"], output)
-        in_bullet_list_item = False
-        in_ordered_list_item = False
-        return result
-    return output
+            ctx.in_ordered_list_item = True
+        return content_obj["content"]
+    return None
+
+
+# Leave a bullet or ordered list item
+def finish_list_item_type(ctx, content_obj):
+    ctx.in_bullet_list_item = False
+    ctx.in_ordered_list_item = False
 
 
 # Handle images
-def parse_image_type(content_obj, output):
-    global document, current_paragraph, current_path
-    if "attrs" in content_obj.keys() and "fileName" in content_obj["attrs"].keys():
+def parse_image_type(ctx, content_obj):
+    if "attrs" in content_obj and "fileName" in content_obj["attrs"]:
         image_file_name = content_obj["attrs"]["fileName"]
-        image_file_path = get_image_path(image_file_name)
+        image_file_path = get_image_path(image_file_name, ctx.current_path)
         if image_file_path is not None:
-            if current_table_cell is None:
-                document.add_picture(image_file_path, Length(in_to_emu(6)))
+            if ctx.current_table_cell is None:
+                ctx.document.add_picture(image_file_path, DOCUMENT_IMAGE_WIDTH)
             else:
-                current_paragraph.add_run().add_picture(
-                    image_file_path, Length(in_to_emu(1))
+                if ctx.use_table_cell_paragraph:  # image is the cell's first content
+                    ctx.current_paragraph = ctx.current_table_cell.paragraphs[0]
+                    ctx.use_table_cell_paragraph = False
+                ctx.current_paragraph.add_run().add_picture(
+                    image_file_path, TABLE_CELL_IMAGE_WIDTH
                 )
         else:
-            current_paragraph.add_run("MISSING IMAGE: " + image_file_name)
-        return output + "image: " + image_file_name
+            ctx.current_paragraph.add_run("MISSING IMAGE: " + image_file_name)
+        ctx.output_chunks.append("image: " + image_file_name)
+    return None
 
 
 # Handle tables, unlike the other handlers, this one requires us
 # to figure out the table structure before adding content
-def parse_table_type(content_obj, output):
-    global document, use_table_cell_paragraph, current_table_cell
+def parse_table_type(ctx, content_obj):
     # Two passees through table data, once to determine dimensions and merged cells,
     # the other to fill the content
     r, c = get_table_dimensions(content_obj)
 
     # Tracking cell indexes in the table format is tricy due to the rowspans and colspans
     # Let's keep track of which cells have been allocated, so we can index more easily
-    # A value of True indicates that this cell has already been "used" by a prior table cell's definition
+    # A non-zero value indicates that this cell has already been "used" by a prior table cell's definition
     cell_tracking = get_cell_tracking_table(r, c)
 
     # Extract all table cells in order
     table_cell_objs = get_table_cell_objs(content_obj)
 
     # Get all the cells that need to be merged
-    cell_merges = get_table_cell_merges(cell_tracking, table_cell_objs)
+    cell_merges = get_table_cell_merges(cell_tracking, r, c, table_cell_objs)
 
     # Add the table to the document
-    table = document.add_table(r, c, "Table Grid")
+    table = ctx.document.add_table(r, c, "Table Grid")
 
     # Merge table cells that need merging
     merge_table_cells(table, cell_merges)
 
-    # Table is finally ready, populate it.
-    for table_cell_obj in table_cell_objs:
-        parse_table_cell_type(table_cell_obj, table)
+    # Table is finally ready, populate it by walking its cells
+    ctx.enclosing_tables.append((ctx.current_table, ctx.current_table_cell, ctx.use_table_cell_paragraph))
+    ctx.current_table = table
+    ctx.output_chunks.append("<Table " + str(r) + " x " + str(c) + ">")
+    return table_cell_objs
 
-    current_table_cell = None
-    use_table_cell_paragraph = False
 
-    return output + "<Table " + str(r) + " x " + str(c) + ">"
+# Leave a table once all its cells have been populated
+def finish_table_type(ctx, content_obj):
+    ctx.current_table, ctx.current_table_cell, ctx.use_table_cell_paragraph = ctx.enclosing_tables.pop()
 
 
-# Handle a table cell
-def parse_table_cell_type(table_cell_obj, table):
-    global current_paragraph, current_table_cell, use_table_cell_paragraph
+# Handle a table cell, walked as one of the children of its table
+def parse_table_cell_type(ctx, table_cell_obj):
 
     row_idx = table_cell_obj["row_idx"]
     col_idx = table_cell_obj["col_idx"]
 
-    current_table_cell = table.cell(row_idx, col_idx)
+    ctx.current_table_cell = ctx.current_table.cell(row_idx, col_idx)
     # current_paragraph = table.cell(row_idx, col_idx).paragraphs[0]
-    use_table_cell_paragraph = True
+    ctx.use_table_cell_paragraph = True
 
-    parse_contents(table_cell_obj["content"], "")
+    return table_cell_obj["content"]
 
 
 # Merge table cells according to input
@@ -650,34 +718,33 @@ def merge_table_cells(table, cell_merges):
 
 
 # Figure out which cells in the table are part of a merge
-def get_table_cell_merges(cell_tracking, table_cell_objs):
-    table_cell_objs_copy = table_cell_objs.copy()
-    table_cell_objs_copy.reverse()  # reverse so we can pop our way throw the list
+def get_table_cell_merges(cell_tracking, r, c, table_cell_objs):
+    table_cell_obj_iter = iter(table_cell_objs)  # cells are assigned to slots in order
     # schema: (row index, column index) : (rowspan, colspan)
     cell_merges = {}
     # Iterate through the cell tracking table and write the index of each table cell
-    for i_row in range(len(cell_tracking)):
-        for i_col in range(len(cell_tracking[i_row])):
-            if cell_tracking[i_row][i_col]:
+    for i_row in range(r):
+        for i_col in range(c):
+            if cell_tracking[i_row * c + i_col]:
                 continue
             else:
-                cell_tracking[i_row][i_col] = True
-                table_cell_obj = table_cell_objs_copy.pop()
+                cell_tracking[i_row * c + i_col] = 1
+                table_cell_obj = next(table_cell_obj_iter)
                 table_cell_obj["row_idx"] = i_row
                 table_cell_obj["col_idx"] = i_col
                 rowspan = 1
                 colspan = 1
-                if "attrs" in table_cell_obj.keys():
-                    if "rowspan" in table_cell_obj["attrs"].keys():
+                if "attrs" in table_cell_obj:
+                    if "rowspan" in table_cell_obj["attrs"]:
                         rowspan = table_cell_obj["attrs"]["rowspan"]
-                    if "colspan" in table_cell_obj["attrs"].keys():
+                    if "colspan" in table_cell_obj["attrs"]:
                         colspan = table_cell_obj["attrs"]["colspan"]
 
                 if rowspan > 1 or colspan > 1:
                     cell_merges[(i_row, i_col)] = (rowspan, colspan)
                     for i_r in range(i_row, i_row + rowspan):
                         for i_c in range(i_col, i_col + colspan):
-                            cell_tracking[i_r][i_c] = True
+                            cell_tracking[i_r * c + i_c] = 1
     return cell_merges
 
 
@@ -686,13 +753,13 @@ def get_table_cell_objs(content_obj):
     table_cell_objs = []
     for table_content_obj in content_obj["content"]:
         if (
-            "type" in table_content_obj.keys()
+            "type" in table_content_obj
             and table_content_obj["type"] == "table_row"
         ):
             # Iterate through table cells
             for row_content_obj in table_content_obj["content"]:
                 if (
-                    "type" in row_content_obj.keys()
+                    "type" in row_content_obj
                     and row_content_obj["type"] == "table_cell"
                 ):
                     table_cell_objs.append(row_content_obj)
@@ -713,32 +780,27 @@ def get_table_dimensions(content_obj):
     # First row will give us our width by adding up the colspan
     for row_obj in row_objs[0]["content"]:
         if (
-            "type" in row_obj.keys()
+            "type" in row_obj
             and row_obj["type"] == "table_cell"
-            and "attrs" in row_obj.keys()
+            and "attrs" in row_obj
         ):
-            if "colspan" in row_obj["attrs"].keys():
+            if "colspan" in row_obj["attrs"]:
                 num_cols += row_obj["attrs"]["colspan"]
 
     return num_rows, num_cols
 
 
 # Helper table used to determine the indexes of table cell objects
+# Stored flat, row by row, so cell (i_row, i_col) is at index i_row * c + i_col
 def get_cell_tracking_table(r, c):
-    cell_tracking = []
-    for _ in range(r):
-        row = []
-        for _ in range(c):
-            row.append(False)
-        cell_tracking.append(row)
-    return cell_tracking
-
-def parse_horizontal_rule_type(content_obj, output):
-    global document, current_paragraph
-    if current_paragraph is None:
-      current_paragraph = document.add_paragraph()
-    insert_horizontal_rule(current_paragraph)
-    return output + "\n----------\n"
+    return bytearray(r * c)
+
+def parse_horizontal_rule_type(ctx, content_obj):
+    if ctx.current_paragraph is None:
+      ctx.current_paragraph = ctx.document.add_paragraph()
+    insert_horizontal_rule(ctx.current_paragraph)
+    ctx.output_chunks.append("\n----------\n")
+    return None
 
 # Horizontal rule helper
 def insert_horizontal_rule(paragraph):
@@ -755,57 +817,75 @@ def insert_horizontal_rule(paragraph):
         'w:pPrChange'
     )
     bottom = OxmlElement('w:bottom')
-    bottom.set(qn('w:val'), 'single')
-    bottom.set(qn('w:sz'), '6')
-    bottom.set(qn('w:space'), '1')
-    bottom.set(qn('w:color'), 'auto')
+    bottom.set(QN_VAL, 'single')
+    bottom.set(QN_SZ, '6')
+    bottom.set(QN_SPACE, '1')
+    bottom.set(QN_COLOR, 'auto')
     pBdr.append(bottom)
 
 # Parse call out box
-def parse_call_out_box(content_obj, output):
-    global callout_bg_color, in_callout, callout_emoji
-    in_callout = True
-
-    callout_emoji = ""
-    if "attrs" in content_obj.keys():
-      if "backgroundColor" in content_obj["attrs"].keys():
-        callout_bg_color = (content_obj["attrs"]["backgroundColor"])[1:]
-      if "emoji" in content_obj["attrs"].keys():
-          callout_emoji = content_obj["attrs"]["emoji"]
-
-    if "content" in content_obj.keys():
-        result = parse_contents(content_obj["content"], output + callout_emoji + " ") + "\n"
-        in_callout = False
-        return result
+def parse_call_out_box(ctx, content_obj):
+    ctx.in_callout = True
+
+    ctx.callout_emoji = ""
+    if "attrs" in content_obj:
+      if "backgroundColor" in content_obj["attrs"]:
+        ctx.callout_bg_color = (content_obj["attrs"]["backgroundColor"])[1:]
+      if "emoji" in content_obj["attrs"]:
+          ctx.callout_emoji = content_obj["attrs"]["emoji"]
+
+    if "content" in content_obj:
+        # Callout gets put in a table since that's close enough. All of its
+        # paragraphs go into the table's one cell, starting with the emoji
+        callout_table = ctx.document.add_table(1,1)
+        cell = callout_table.cell(0,0)
+        set_cell_background_color(cell, ctx.callout_bg_color)
+        cell.paragraphs[0].add_run(" " + ctx.callout_emoji + "  ")
+
+        ctx.table_cell_outside_callout = ctx.current_table_cell
+        ctx.current_table_cell = cell
+        ctx.use_table_cell_paragraph = True
+
+        ctx.output_chunks.append(ctx.callout_emoji + " ")
+        return content_obj["content"]
     
-    return output
+    return None
+
+# Leave a call out box once its content has been parsed
+def finish_call_out_box(ctx, content_obj):
+    ctx.in_callout = False
+    ctx.current_table_cell = ctx.table_cell_outside_callout
+    ctx.table_cell_outside_callout = None
+    ctx.use_table_cell_paragraph = False
+    ctx.output_chunks.append("\n")
 
 # Parse call out box
-def parse_code_block(content_obj, output):
-    global document, current_paragraph, in_code_block
-    in_code_block = True
+def parse_code_block(ctx, content_obj):
+    ctx.in_code_block = True
 
     # Make a table for the code content, set it to a monospace font
-    table = document.add_table(1, 1)
+    table = ctx.document.add_table(1, 1)
     cell = table.cell(0, 0)
     set_cell_background_color(cell, "ccdff7")
-    current_paragraph = cell.paragraphs[0]
+    ctx.current_paragraph = cell.paragraphs[0]
 
-    if "content" in content_obj.keys():
-        result = parse_contents(content_obj["content"], output) + "\n"
-        in_code_block = False
-        return result
+    if "content" in content_obj:
+        return content_obj["content"]
     
-    return output
+    return None
+
+# Leave a code block once its content has been parsed
+def finish_code_block(ctx, content_obj):
+    ctx.in_code_block = False
+    ctx.output_chunks.append("\n")
 
 # Parse call out box
-def parse_blockquote(content_obj, output):
-    if "content" in content_obj.keys():
-        result = parse_contents(content_obj["content"], output) + "\n"
-        in_code_block = False
-        return result
-    
-    return output
+def parse_blockquote(ctx, content_obj):
+    return content_obj.get("content")
+
+# Leave a block quote once its content has been parsed
+def finish_blockquote(ctx, content_obj):
+    ctx.output_chunks.append("\n")
 
 # Get the appropriate list character(s) for this list item
 # Box has numbers, then lowercase letters, then roman numerals
@@ -816,72 +896,156 @@ def get_ordered_list_char(ordered_list_level, list_depth):
         return str(list_depth) + "."
 
     elif a == 2:  # letters
-        # convert to base-26, then convert each digit to the corresponding letter
-        digits = []
-        n = list_depth  # since we start at 1 instead of 0
-        while n > 0:
-            digits.insert(0, n % 26)
-            n = n // 26
-
-        char = ""
-        for digit in digits:
-            char += chr(digit + 96)
-        return char + "."
+        if 1 <= list_depth <= len(LETTER_LIST_CHARS):  # nearly every list stays within a-z
+            return LETTER_LIST_CHARS[list_depth - 1]
+        return get_letter_list_char(list_depth)
 
     else:  # roman
-        return roman.toRoman(list_depth).lower() + "."
+        return get_roman_list_char(list_depth)
+
+
+# Lettered list character, e.g. "c." for the third item
+@lru_cache(maxsize=256)
+def get_letter_list_char(list_depth):
+    # convert to base-26 with digits a-z (a..z, aa..az, ba..), least significant first
+    letters = []
+    n = list_depth
+    while n > 0:
+        n, digit = divmod(n - 1, 26)  # -1 since we start at 1 instead of 0
+        letters.append(string.ascii_lowercase[digit])
+    return "".join(reversed(letters)) + "."
+
+
+# Roman numeral list character, e.g. "iii." for the third item
+@lru_cache(maxsize=256)
+def get_roman_list_char(list_depth):
+    return roman.toRoman(list_depth).lower() + "."
 
 
 # Convert from RGB Hex code to RGBColor object
+@lru_cache(maxsize=128)
 def get_color_from_hex(hex):
-    r = int(hex[1:3], 16)
-    g = int(hex[3:5], 16)
-    b = int(hex[5:7], 16)
-    return RGBColor(r, g, b)
+    if len(hex) < 7:
+        raise ValueError(f"invalid hex color {hex!r}, expected #rrggbb")
+    rgb = int(hex[1:7], 16)
+    return RGBColor((rgb >> 16) & 0xFF, (rgb >> 8) & 0xFF, rgb & 0xFF)
 
 
 
 # Convert from em to pt
+@lru_cache(maxsize=128)
 def get_pt_from_em(em):
-    size = float(em[:-2]) // 0.083646
+    size = int(float(em[:-2]) * PT_PER_EM)
     return Pt(size)
 
 
-# Search the current file's folder and its parents for the box image name specified
-def get_image_path(img_file_name):
-    global current_path
+# Search the current file's folder and its parents for the box image name specified.
+# Both the images folder and its listing are cached, so this is two dict lookups
+def get_image_path(img_file_name, current_path):
+    images_dir = get_images_dir(current_path)
+    if images_dir is None:
+        return None
+
+    image_path = get_image_files(images_dir).get(img_file_name)
+    if image_path is None:
+        # Names can differ from the listing only by case or unicode normalization
+        # on macOS and Windows, where the file system still finds the file
+        image_path = os.path.join(images_dir, img_file_name)
+        if not os.path.isfile(image_path):
+            return None
 
-    # Try the current directory and all parents to see if the Box Note Image is available
-    [base_path, tail] = os.path.split(current_path)
-    file_name = tail[:-8]  # remove .boxnote
-    extra_path = "Box Notes Images" + os.path.sep + file_name + " Images"
+    return image_path
 
-    while tail != "":
-        img_file_path = (
-            base_path + os.path.sep + extra_path + os.path.sep + img_file_name
-        )
 
-        if os.path.exists(img_file_path) and os.path.isfile(img_file_path):
-            return img_file_path
+# List the image files in a Box Note Images folder, by name, with a single directory read
+@lru_cache(maxsize=256)
+def get_image_files(images_dir):
+    try:
+        with os.scandir(images_dir) as entries:
+            return {entry.name: entry.path for entry in entries if entry.is_file()}
+    except OSError:
+        return {}
 
-        [base_path, tail] = os.path.split(base_path)
-        if base_path in BOX_ROOTS:  # Actual break condition
+
+# Find the Box Note Images folder for the current file, searching its folder and all parents
+@lru_cache(maxsize=256)
+def get_images_dir(current_path):
+    current_path = pathlib.PurePath(current_path)
+    file_name = current_path.stem if current_path.suffix == ".boxnote" else current_path.name
+    extra_path = os.path.join("Box Notes Images", file_name + " Images")
+
+    for base_path in current_path.parents:
+        images_dir = os.path.join(base_path, extra_path)
+
+        if os.path.isdir(images_dir):
+            return images_dir
+
+        if os.path.normcase(base_path.parent) in BOX_ROOTS:  # Actual break condition
             return None
 
     return None
 
 
-# Convert inches to emu
-def in_to_emu(inches):
-    return inches * 914400
-
 # Set a table cell's background color
 def set_cell_background_color(cell, bgcolor):
   tc = cell._tc
   tc_props = tc.get_or_add_tcPr()
+  tc_props.append(copy.deepcopy(get_cell_shading(bgcolor)))
+
+# Shading element for a table cell background color. Built once per color and
+# copied for each cell, since copying is cheaper than building a new element
+@lru_cache(maxsize=64)
+def get_cell_shading(bgcolor):
   tc_shading = OxmlElement('w:shd')
-  tc_shading.set(qn('w:fill'), bgcolor)
-  tc_props.append(tc_shading)
+  tc_shading.set(QN_FILL, bgcolor)
+  return tc_shading
+
+
+# Map each content type to the function that handles it
+content_type_handler_map = {
+    "heading": parse_heading_type,
+    "paragraph": parse_paragraph_type,
+    "text": parse_text_type,
+    "bullet_list": parse_bullet_list_type,
+    "ordered_list": parse_ordered_list_type,
+    "check_list": parse_check_list_type,
+    "list_item": parse_list_item_type,
+    "check_list_item": parse_check_list_item_type,
+    "image": parse_image_type,
+    "table": parse_table_type,
+    "table_cell": parse_table_cell_type,
+    "horizontal_rule": parse_horizontal_rule_type,
+    "call_out_box": parse_call_out_box,
+    "code_block": parse_code_block,
+    "blockquote": parse_blockquote,
+}
+
+# Map each text mark type to the function that applies it to a run's style
+text_mark_handler_map = {
+    "strong": lambda style, attrs: setattr(style, "is_bold", True),
+    "em": lambda style, attrs: setattr(style, "is_italic", True),
+    "underline": lambda style, attrs: setattr(style, "is_underline", True),
+    "strikethrough": lambda style, attrs: setattr(style, "is_strikethrough", True),
+    "font_size": parse_font_size_mark,
+    "font_color": parse_font_color_mark,
+    "highlight": parse_highlight_mark,
+    "link": parse_link_mark,
+}
+
+# Map each content type with children to the function that finishes it after they are parsed
+content_type_finish_handler_map = {
+    "heading": finish_heading_type,
+    "paragraph": finish_paragraph_type,
+    "bullet_list": finish_bullet_list_type,
+    "ordered_list": finish_ordered_list_type,
+    "check_list": finish_check_list_type,
+    "list_item": finish_list_item_type,
+    "check_list_item": finish_check_list_item_type,
+    "table": finish_table_type,
+    "call_out_box": finish_call_out_box,
+    "code_block": finish_code_block,
+    "blockquote": finish_blockquote,
+}
 
 
 if __name__ == "__main__":